@@ -20,33 +20,174 @@
 
 import h11
 import curio
+from wsproto import ConnectionType, ConnectionState, WSConnection
+from wsproto.frame_protocol import CloseReason
+from wsproto.utilities import RemoteProtocolError
+from wsproto.events import (
+    AcceptConnection, BytesMessage, CloseConnection, Message, Ping, Request,
+    TextMessage)
 
+import json
+import time
+import struct
 import traceback
-from socket import SHUT_WR
+from enum import Enum
+from math import ceil
+from os.path import getsize
+from ipaddress import ip_address
 from itertools import count
+from socket import SHUT_WR, SOL_SOCKET, SO_LINGER
 from wsgiref.handlers import format_date_time
 
 DEFAULT_PORT = 9090
 DEFAULT_TIMEOUT = 10  # Seconds.
+DEFAULT_KEEPALIVE_TIMEOUT = 60  # Seconds.
+DEFAULT_LINGER_TIMEOUT = 2  # Seconds.
+DEFAULT_WEBSOCKET_IDLE_TIMEOUT = 5 * 60  # Seconds.
 DEFAULT_INTERFACE = ''
+DEFAULT_BACKLOG = 1024  # Pending, not yet accepted, connections.
+DEFAULT_MAX_CONNECTIONS = 2 ** 16
+DEFAULT_ACCEPT_RETRY_DELAY = 0.1  # Seconds.
+DEFAULT_TIMER_RESOLUTION = 0.5  # Seconds.
+DEFAULT_TIMER_SLOTS = 512
 DEFAULT_MAX_RECEIVE_SIZE = 2 ** 16  # Bytes.
+DEFAULT_MAX_WEBSOCKET_MESSAGE_SIZE = 2 ** 24  # Bytes.
+DEFAULT_MAX_WEBSOCKET_INFLIGHT = 16  # Concurrently handled messages.
+
+SERVER_NAME = (
+    f'plain-http-server curio:{curio.__version__} h11:{h11.__version__}'
+    .encode('ascii'))
 
 def callableAttr(obj, attr):
     return hasattr(obj, attr) and callable(getattr(obj, attr))
 
+def requestHeader(req, name, default=None):
+    name = name.lower().encode('ascii')  # h11 lowercases header names.
+    for key, value in req.headers:
+        if key == name:
+            return value.decode('latin1')
+    return default
+
+def isWebSocketUpgrade(req):
+    connection = requestHeader(req, 'Connection', '').lower()
+    upgrade = requestHeader(req, 'Upgrade', '').lower()
+    return 'upgrade' in connection and upgrade == 'websocket'
+
+
+class UnsatisfiableRange(ValueError):
+    pass
+
+
+class ConnectionTimeout(curio.CancelledError):
+    pass
+
+
+class TimeoutKind(Enum):  # Which of a connection's timeouts is pending.
+    KEEPALIVE = 'keep-alive'  # Idle, waiting for the next request to start.
+    REQUEST = 'request'  # Waiting for a started request to finish.
+    LINGER = 'linger'  # Waiting for the client to close after our shutdown.
+    WEBSOCKET_IDLE = 'websocket-idle'  # Idle WebSocket.
+
+
+def parseRangeHeader(value, size):  # Raises UnsatisfiableRange.
+    """
+    Return the inclusive (start, end) byte range requested by Range
+    header <value> of a resource <size> bytes long, or None if the
+    whole resource should be sent. Only single byte ranges are
+    supported; multiple and malformed ranges, including those whose last
+    byte precedes their first, are ignored, as RFC 7233 permits, and the
+    whole resource is sent instead.
+    """
+    unit, _, spec = (value or '').partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    first, _, last = spec.strip().partition('-')
+    if not (first + last).isdigit():
+        return None
+    if first and last and int(last) < int(first):  # Invalid, e.g. 'bytes=5-3'.
+        return None
+
+    if first:  # 'bytes=500-999' or 'bytes=500-'.
+        start = int(first)
+        end = int(last) if last else size - 1
+    else:  # Suffix range, like 'bytes=-500' for the last 500 bytes.
+        start = max(size - int(last), 0)
+        end = size - 1 if int(last) else -1
+
+    if start >= size:
+        raise UnsatisfiableRange(f'Range {value} not satisfiable.')
+
+    return start, min(end, size - 1)
+
+
+class TimerWheel:
+    """
+    A hashed timing wheel that enforces the timeouts of every connection
+    from a single task, instead of a curio timeout per connection and
+    event. Scheduling, rescheduling, and cancelling a timeout are O(1),
+    which matters when tens of thousands of mostly idle connections
+    reschedule their timeouts on every request, and each tick only
+    visits the timeouts in one slot. Timeouts fire up to <resolution>
+    seconds late.
+
+    When a timeout fires, its task is cancelled with ConnectionTimeout.
+    """
+    def __init__(self, resolution=None, numSlots=None):
+        self.resolution = resolution or DEFAULT_TIMER_RESOLUTION  # Seconds.
+        self.slots = [{} for _ in range(numSlots or DEFAULT_TIMER_SLOTS)]
+        self.timers = {}  # Task -> slot, i.e. {task: expiryTick}, it's in.
+        self.tick = self._currentTick()
+
+    def schedule(self, task, timeout):
+        self.cancel(task)
+        expiry = self._currentTick() + max(1, ceil(timeout / self.resolution))
+        slot = self.slots[expiry % len(self.slots)]
+        slot[task] = expiry
+        self.timers[task] = slot
+
+    def cancel(self, task):
+        slot = self.timers.pop(task, None)
+        if slot is not None:
+            del slot[task]
+
+    async def runForever(self):
+        while True:
+            await curio.sleep(self.resolution)
+
+            # Catch up on every tick since the last one, in case the kernel
+            # was too busy to wake this task up on time.
+            now = self._currentTick()
+            while self.tick < now:
+                self.tick += 1
+                slot = self.slots[self.tick % len(self.slots)]
+                expired = [t for t, tick in slot.items() if tick <= self.tick]
+                for task in expired:
+                    self.cancel(task)
+                    await task.cancel(exc=ConnectionTimeout, blocking=False)
+
+    def _currentTick(self):
+        return int(time.monotonic() / self.resolution)
+
 
 class PlainHTTPSocketWrapper:
     _connectionIterator = count()  # Unique int per connection. For debugging.
+    serverName = SERVER_NAME
+    webSocketIdleTimeout = DEFAULT_WEBSOCKET_IDLE_TIMEOUT  # Seconds.
+    maxWebSocketMessageSize = DEFAULT_MAX_WEBSOCKET_MESSAGE_SIZE  # Bytes.
+    maxWebSocketInflight = DEFAULT_MAX_WEBSOCKET_INFLIGHT
 
-    def __init__(self, server, sock, maxRecvSize=None):
+    def __init__(self, server, sock, addr=None, maxRecvSize=None):
         self.server = server
         self.sock = sock
+        self.addr = addr  # Client's (host, port).
+        self.task = None  # Curio task serving this connection.
+        # TimeoutKind of the most recently set timeout. Kept after the timeout
+        # fires, or is cleared, so abortConnection() knows which one fired.
+        self.timeoutKind = None
         self.http = h11.Connection(h11.SERVER)
         self.uid = next(self._connectionIterator)
         self.maxRecvSize = maxRecvSize or DEFAULT_MAX_RECEIVE_SIZE
-        h = h11.__version__
-        c = curio.__version__
-        self.serverName = f'plain-http-server curio:{c} h11:{h}'.encode('ascii')
 
     async def getNextEvent(self):
         while True:
@@ -63,19 +204,63 @@ class PlainHTTPSocketWrapper:
         data = self.http.send(event)
         await self.sock.sendall(data)
 
-    async def sendTextResponse(self, statusCode, text):
+    async def sendTextResponse(self, statusCode, text, extraHeaders=None):
         if callableAttr(text, 'encode'):  # String to bytes.
             text = text.encode('utf8')
         mimetype = 'text/plain; charset=utf-8'
-        await self.sendSimpleResponse(statusCode, mimetype, text)
+        await self.sendSimpleResponse(statusCode, mimetype, text, extraHeaders)
 
-    async def sendSimpleResponse(self, statusCode, contentType, body):
+    async def sendJSONResponse(self, statusCode, obj, extraHeaders=None):
+        body = json.dumps(obj).encode('utf8')
+        mimetype = 'application/json'
+        await self.sendSimpleResponse(statusCode, mimetype, body, extraHeaders)
+
+    async def sendSimpleResponse(self, statusCode, contentType, body,
+                                 extraHeaders=None):
         headers = self.createResponseHeaders(contentType, len(body))
+        headers += extraHeaders or []
         resp = h11.Response(status_code=statusCode, headers=headers)
         await self.send(resp)
         await self.send(h11.Data(data=body))
         await self.send(h11.EndOfMessage())
 
+    async def sendFileResponse(self, contentType, fpath, rangeHeader=None):
+        # Stream <fpath> to the client in chunks instead of reading it into
+        # memory whole, honoring a single byte range in <rangeHeader>, if
+        # provided. <fpath> may still be growing, so its size is sampled once,
+        # up front, and never more than that many bytes are sent.
+        size = getsize(fpath)
+        try:
+            byteRange = parseRangeHeader(rangeHeader, size)
+        except UnsatisfiableRange as e:
+            headers = [('Content-Range', f'bytes */{size}')]
+            await self.sendTextResponse(416, str(e), headers)
+            return
+
+        statusCode, (start, end) = 200, (0, size - 1)
+        headers = self.createResponseHeaders(contentType, size)
+        if byteRange:
+            statusCode, (start, end) = 206, byteRange
+            headers = self.createResponseHeaders(contentType, end - start + 1)
+            headers.append(('Content-Range', f'bytes {start}-{end}/{size}'))
+        headers.append(('Accept-Ranges', 'bytes'))
+
+        await self.send(h11.Response(status_code=statusCode, headers=headers))
+        remaining = end - start + 1
+        async with curio.aopen(fpath, 'rb') as f:
+            await f.seek(start)
+            while remaining > 0:
+                chunk = await f.read(min(remaining, self.maxRecvSize))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await self.send(h11.Data(data=chunk))
+                # Give slow, but progressing, downloads <connectionTimeout>
+                # per chunk instead of for the whole response.
+                timeout = self.server.connectionTimeout
+                self.setTimeout(timeout, TimeoutKind.REQUEST)
+        await self.send(h11.EndOfMessage())
+
     async def sendExceptionResponse(self, exc):
         if self.http.our_state not in {h11.IDLE, h11.SEND_RESPONSE}:
             return
@@ -89,9 +274,132 @@ class PlainHTTPSocketWrapper:
             print(f'Failed to send error response to client:')
             traceback.print_exception(None, exc, exc.__traceback__)
 
-    async def handleRequest(self, req):
+    async def handleRequest(self, req, data=None):
         await self.sendTextResponse(200, 'hello')
 
+    def streamsRequestBody(self, req):
+        # Return True to have handleRequest() called as soon as <req>'s
+        # headers arrive, without its body, which handleRequest() then reads
+        # itself with iterRequestBody(). The body is delivered as raw bytes,
+        # without being buffered or decoded.
+        return False
+
+    async def iterRequestBody(self):
+        while True:
+            event = await self.getNextEvent()
+            if type(event) is h11.Data:
+                # Give slow, but progressing, uploads <connectionTimeout> per
+                # chunk instead of for the whole request.
+                timeout = self.server.connectionTimeout
+                self.setTimeout(timeout, TimeoutKind.REQUEST)
+                yield event.data
+            elif type(event) is h11.EndOfMessage:
+                return
+
+    def setTimeout(self, timeout, kind):
+        self.timeoutKind = kind
+        self.server.timers.schedule(self.task, timeout)
+
+    def startRequestTimeout(self):
+        # Switch from <keepAliveTimeout> to <connectionTimeout> as soon as a
+        # request starts, i.e. on its first bytes, not once its headers are
+        # complete, so clients that trickle in their headers (e.g. slowloris)
+        # are bound by <connectionTimeout>.
+        if self.timeoutKind is TimeoutKind.KEEPALIVE:
+            timeout = self.server.connectionTimeout
+            self.setTimeout(timeout, TimeoutKind.REQUEST)
+
+    def clearTimeout(self):
+        self.server.timers.cancel(self.task)
+
+    def acceptsWebSocket(self, req):
+        return isWebSocketUpgrade(req)
+
+    async def handleWebSocketMessage(self, message):
+        # Return a str or bytes reply to send back to the client, or None to
+        # not reply.
+        return message  # Echo.
+
+    async def sendWebSocketMessage(self, message):
+        if self.ws.state is not ConnectionState.OPEN:
+            return  # Closed while the message was being handled.
+        if callableAttr(message, 'encode'):
+            event = TextMessage(data=message)
+        else:
+            event = BytesMessage(data=message)
+        await self._sendWebSocketEvent(event)
+
+    async def serveWebSocket(self, req):
+        # Hand the connection over from h11 to wsproto. h11 has already parsed
+        # the upgrade request, so pass it to wsproto as-is, along with any
+        # bytes the client sent after it, like eagerly sent WebSocket frames.
+        self.ws = WSConnection(ConnectionType.SERVER)
+        try:
+            self.ws.initiate_upgrade_connection(req.headers, req.target)
+        except RemoteProtocolError as e:  # E.g. Sec-WebSocket-Key is missing.
+            # Reject the upgrade over HTTP, as h11 hasn't sent a response yet,
+            # with the status and headers, like Sec-WebSocket-Version, wsproto
+            # suggests.
+            hint = e.event_hint
+            await self.sendTextResponse(hint.status_code, str(e), hint.headers)
+            await self.closeConnection()
+            return
+        trailing, _ = self.http.trailing_data
+        if trailing:
+            self.ws.receive_data(trailing)
+
+        # Messages are handled concurrently, each in its own task, so one slow
+        # message doesn't hold up those behind it. Clients match replies to
+        # messages themselves, e.g. with correlation ids in each message.
+        # Stop reading from the socket while <maxWebSocketInflight> messages
+        # are being handled so a chatty client can't spawn unbounded tasks.
+        self._wsSendLock = curio.Lock()
+        inflight = curio.Semaphore(self.maxWebSocketInflight)
+
+        tasks = set()
+        fragments, size = [], 0
+        try:
+            while True:
+                for event in self.ws.events():
+                    if isinstance(event, Request):
+                        await self._sendWebSocketEvent(AcceptConnection())
+                    elif isinstance(event, Ping):
+                        await self._sendWebSocketEvent(event.response())
+                    elif isinstance(event, CloseConnection):
+                        if self.ws.state is ConnectionState.REMOTE_CLOSING:
+                            await self._sendWebSocketEvent(event.response())
+                        return
+                    elif isinstance(event, Message):
+                        fragments.append(event.data)
+                        size += len(event.data)
+                        if size > self.maxWebSocketMessageSize:
+                            code = CloseReason.MESSAGE_TOO_BIG
+                            close = CloseConnection(code=code)
+                            await self._sendWebSocketEvent(close)
+                            return
+                        if not event.message_finished:
+                            continue
+
+                        joiner = '' if isinstance(event, TextMessage) else b''
+                        message = joiner.join(fragments)
+                        fragments, size = [], 0
+
+                        await inflight.acquire()
+                        tasks = {t for t in tasks if not t.terminated}
+                        tasks.add(await curio.spawn(
+                            self._handleWebSocketMessage, message, inflight,
+                            daemon=True))
+
+                self.setTimeout(
+                    self.webSocketIdleTimeout, TimeoutKind.WEBSOCKET_IDLE)
+                data = await self._receive()
+                if not data:
+                    return
+                self.ws.receive_data(data)
+        finally:
+            for task in tasks:
+                await task.cancel()
+
     async def closeConnection(self):
         # When this method is called, it's because we definitely want to kill
         # this connection, either as a clean shutdown or because of some kind
@@ -109,22 +417,43 @@ class PlainHTTPSocketWrapper:
                 return  # Connection already closed.
 
         # Wait and read for a bit to give them a chance to see that we closed
-        # things, but eventually give up and just close the socket.
-        # XX FIXME: possibly we should set SO_LINGER to 0 here, so
-        # that in the case where the client has ignored our shutdown and
-        # declined to initiate the close themselves, we do a violent shutdown
-        # (RST) and avoid the TIME_WAIT?
-        # it looks like nginx never does this for keepalive timeouts, and only
-        # does it for regular timeouts (slow clients I guess?) if explicitly
-        # enabled ("Default: reset_timedout_connection off")
-        async with curio.ignore_after(TIMEOUT):
+        # things, but eventually give up and just close the socket. Clients
+        # that ignore our shutdown are closed by abortConnection(), which
+        # resets them if the server's resetTimedOutConnections is set.
+        self.setTimeout(self.server.lingerTimeout, TimeoutKind.LINGER)
+        try:
+            while True:  # Attempt to read until end of the request.
+                if not await self._receive():
+                    break
+        except ConnectionTimeout:
+            await self.abortConnection()
+        finally:
+            self.clearTimeout()
+            await self.sock.close()
+
+    async def abortConnection(self):
+        # Close the connection immediately after one of its timeouts fired,
+        # without closeConnection()'s graceful shutdown. If the server's
+        # resetTimedOutConnections is set, like nginx's
+        # reset_timedout_connection, clients that abandoned a request or
+        # ignored our shutdown are reset: SO_LINGER is set to 0 so the close
+        # sends a RST and the socket skips TIME_WAIT. Like nginx, idle
+        # keep-alive and WebSocket connections are always closed normally.
+        abandoned = self.timeoutKind in {
+            TimeoutKind.REQUEST, TimeoutKind.LINGER}
+        if self.server.resetTimedOutConnections and abandoned:
+            linger = struct.pack('ii', 1, 0)  # On, with a 0 second timeout.
             try:
-                while True:  # Attempt to read until end of the request.
-                    ignored = await self.sock.recv(self.maxRecvSize)
-                    if not ignored:
-                        break
-            finally:
-                await self.sock.close()
+                self.sock.setsockopt(SOL_SOCKET, SO_LINGER, linger)
+            except OSError:
+                pass  # Connection already closed.
+        await self.sock.close()
+
+    def isLocalClient(self):
+        try:
+            return ip_address(self.addr[0]).is_loopback
+        except (TypeError, IndexError, ValueError):
+            return False
 
     def createResponseHeaders(self, contentType='text/plain; charset=utf-8',
                               contentLength=None):
@@ -133,29 +462,67 @@ class PlainHTTPSocketWrapper:
             ('Content-Type', contentType),
             ('Date', format_date_time(None).encode('ascii')),
         ]
-        if contentLength:
+        if contentLength is not None:
             headers.append(('Content-Length', str(contentLength)))
         return headers
 
+    async def _receive(self):
+        # Read into the server's receive buffer, shared by every connection,
+        # instead of allocating a new buffer for every read. Sharing is safe
+        # because curio runs all connections in one thread and recv_into()
+        # returns as soon as it reads, so the returned data must be consumed
+        # (i.e. copied, like h11 and wsproto do) before the next await.
+        buf = self.server.receiveBuffer
+        try:
+            nbytes = await self.sock.recv_into(buf, self.maxRecvSize)
+        except ConnectionError:
+            nbytes = 0  # Client closed the connection.
+        return buf[:nbytes]
+
+    async def _sendWebSocketEvent(self, event):
+        async with self._wsSendLock:
+            await self.sock.sendall(self.ws.send(event))
+
+    async def _handleWebSocketMessage(self, message, inflight):
+        try:
+            reply = await self.handleWebSocketMessage(message)
+            if reply is not None:
+                await self.sendWebSocketMessage(reply)
+        except Exception:
+            print(f'Unhandled exception during WebSocket message handler:')
+            print(traceback.format_exc())
+        finally:
+            await inflight.release()
+
     async def _readDataFromClient(self):
         if self.http.they_are_waiting_for_100_continue:
-            headers = self.constructBasicHeaders()
+            headers = [('Server', self.serverName)]
             resp = h11.InformationalResponse(status_code=100, headers=headers)
             await self.send(resp)
-        try:
-            data = await self.sock.recv(self.maxRecvSize)
-        except ConnectionError:
-            data = b''  # Client closed the connection.
+        data = await self._receive()
+        if data:
+            self.startRequestTimeout()
         self.http.receive_data(data)
 
 
 class PlainHTTPServer:
     SocketWrapper = PlainHTTPSocketWrapper
     connectionTimeout = DEFAULT_TIMEOUT  # Seconds.
+    keepAliveTimeout = DEFAULT_KEEPALIVE_TIMEOUT  # Seconds.
+    lingerTimeout = DEFAULT_LINGER_TIMEOUT  # Seconds.
+    resetTimedOutConnections = False  # Close timed out connections with RST.
+    maxConnections = DEFAULT_MAX_CONNECTIONS
     maxReceiveSize = DEFAULT_MAX_RECEIVE_SIZE  # Bytes.
 
     def __init__(self, wrapper=None):
         self.SocketWrapper = wrapper or self.SocketWrapper
+        self.timers = TimerWheel()
+        self.receiveBuffer = memoryview(bytearray(self.maxReceiveSize))
+        self.connectionSlots = curio.Semaphore(self.maxConnections)
+
+    @property
+    def numConnections(self):
+        return self.maxConnections - self.connectionSlots.value
 
     def serveForever(self, interface='', port=None):
         port = port or DEFAULT_PORT
@@ -163,7 +530,7 @@ class PlainHTTPServer:
 
         kernel = curio.Kernel()
         try:
-            kernel.run(curio.tcp_server(interface, port, self.handleConnection))
+            kernel.run(self.serve, interface, port)
         except KeyboardInterrupt:
             # Cancel all daemonic tasks and perform a clean shutdown once all
             # regular tasks have completed.
@@ -172,31 +539,91 @@ class PlainHTTPServer:
                 'tasks to finish...')
             kernel.run(shutdown=True)
 
+    async def serve(self, interface, port):
+        # Accept connections by hand, instead of with curio.tcp_server(), to
+        # cap the number of open connections at <maxConnections>. Further
+        # connections wait in the listen backlog until a slot frees up.
+        sock = curio.tcp_server_socket(
+            interface, port, backlog=DEFAULT_BACKLOG)
+        async with sock:
+            await curio.spawn(self.timers.runForever, daemon=True)
+            while True:
+                await self.connectionSlots.acquire()
+                try:
+                    client, addr = await sock.accept()
+                except OSError as e:  # E.g. EMFILE, out of file descriptors.
+                    await self.connectionSlots.release()
+                    print(f'Failed to accept connection: {e}')
+                    await curio.sleep(DEFAULT_ACCEPT_RETRY_DELAY)
+                    continue
+                await curio.spawn(
+                    self._runConnection, client, addr, daemon=True)
+                del client
+
     async def handleConnection(self, sock, addr):
-        conn = self.SocketWrapper(self, sock, maxRecvSize=self.maxReceiveSize)
+        conn = self.SocketWrapper(
+            self, sock, addr, maxRecvSize=self.maxReceiveSize)
+        conn.task = await curio.current_task()
 
+        try:
+            await self._serveConnection(conn)
+        except ConnectionTimeout:
+            await conn.abortConnection()
+        finally:
+            conn.clearTimeout()
+
+    async def _runConnection(self, sock, addr):
+        try:
+            async with sock:
+                await self.handleConnection(sock, addr)
+        finally:
+            await self.connectionSlots.release()
+
+    async def _serveConnection(self, conn):
         while True:  # Process all requests on this connection.
+            upgrade = None
             try:
-                async with curio.timeout_after(self.connectionTimeout):
-                    req = await conn.getNextEvent()
-                    if type(req) is h11.Request:
-                        # Collect POST data.
-                        #
-                        # TODO(grun): Re-implement handleRequest() to handle
-                        # streamed POST data, not buffer it.
-                        data = ''
-                        while True:
-                            event = await conn.getNextEvent()
-                            if type(event) is h11.Data:
-                                data += event.data.decode('ascii')
-                            elif type(event) is h11.EndOfMessage:
-                                break
+                # Idle connections, and those between requests, get
+                # <keepAliveTimeout> until the first bytes of their next
+                # request arrive, and from then <connectionTimeout> to send
+                # the rest of it and be responded to. Both are enforced by
+                # self.timers, which cancels this task if they expire.
+                conn.setTimeout(self.keepAliveTimeout, TimeoutKind.KEEPALIVE)
+                req = await conn.getNextEvent()
+                conn.startRequestTimeout()  # If pipelined, i.e. already read.
+                if type(req) is h11.Request and conn.streamsRequestBody(req):
+                    # The handler reads the body itself, with
+                    # iterRequestBody().
+                    await conn.handleRequest(req)
+                elif type(req) is h11.Request:
+                    # Collect POST data.
+                    #
+                    # TODO(grun): Re-implement handleRequest() to handle
+                    # streamed POST data, not buffer it.
+                    data = ''
+                    while True:
+                        event = await conn.getNextEvent()
+                        if type(event) is h11.Data:
+                            data += event.data.decode('ascii')
+                        elif type(event) is h11.EndOfMessage:
+                            break
 
+                    if conn.acceptsWebSocket(req):
+                        upgrade = req
+                    else:
                         await conn.handleRequest(req, data)
             except Exception as exc:
                 print(f'Unhandled exception during response handler:')
                 print(traceback.format_exc())
                 await conn.sendExceptionResponse(exc)
+            finally:
+                conn.clearTimeout()
+
+            # WebSocket connections are long-lived and enforce their own idle
+            # timeout, so serve them outside of <connectionTimeout>.
+            if upgrade is not None:
+                await conn.serveWebSocket(upgrade)
+                break
 
             if conn.http.our_state is h11.MUST_CLOSE:
                 await conn.closeConnection()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+# Copyright _!_
+#
+# License _!_
+#
+# Original author: Ansgar Grunseid
+
+# Asynchronous, spool-to-disk utility runs. Where a regular utilbind request
+# runs its utility inline and buffers the output in memory, a Job runs its
+# utility in the background, under a bounded number of concurrent runs, and
+# streams the utility's stdout and stderr straight into spool files on
+# disk. Clients poll a Job's state and fetch its spooled output, in whole or in
+# ranges, whenever they like. Finished Jobs, and their spool files, are removed
+# once they're older than the scheduler's TTL.
+
+import os
+import time
+import shutil
+import tempfile
+import traceback
+from enum import Enum
+from secrets import token_hex
+from subprocess import DEVNULL
+from os.path import getsize, isfile, join as pjoin
+
+import curio
+from curio.meta import finalize
+from curio.subprocess import Popen
+from curio import timeout_after, TaskTimeout, CancelledError
+
+DEFAULT_MAX_RUNNING = 2  # Concurrently running Jobs.
+DEFAULT_MAX_PENDING = 64  # Jobs waiting for a free slot to run.
+DEFAULT_JOB_TIMEOUT = 60 * 60  # Seconds.
+DEFAULT_JOB_TTL = 60 * 60  # Seconds a finished Job is kept around.
+DEFAULT_SWEEP_INTERVAL = 60  # Seconds between removals of expired Jobs.
+DEFAULT_MAX_INPUT_SIZE = 256 * 1024 * 1024  # Bytes of stdin spooled per Job.
+
+
+class TooManyJobs(RuntimeError):
+    pass
+
+
+class JobInputTooLarge(RuntimeError):
+    pass
+
+
+class JobState(Enum):  # Attribute value is the state name exposed over HTTP.
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    TIMED_OUT = 'timed-out'
+    CANCELLED = 'cancelled'
+
+
+class Job:
+    def __init__(self, argv, spoolDirectory, **info):
+        self.id = token_hex(16)
+        self.argv = argv
+        self.info = info  # Arbitrary, JSON serializable Job metadata.
+        self.state = JobState.PENDING
+        self.returncode = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.task = None
+
+        spoolPath = pjoin(spoolDirectory, self.id)
+        self.stdinPath = f'{spoolPath}.stdin'
+        self.stdoutPath = f'{spoolPath}.stdout'
+        self.stderrPath = f'{spoolPath}.stderr'
+
+    @property
+    def isDone(self):
+        return self.state not in {JobState.PENDING, JobState.RUNNING}
+
+    def isExpired(self, ttl, now=None):
+        now = now or time.time()
+        return self.isDone and self.finished + ttl < now
+
+    def spooledSize(self, path):
+        return getsize(path) if isfile(path) else 0
+
+    def toDict(self):
+        return {
+            'id': self.id,
+            'state': self.state.value,
+            'returncode': self.returncode,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'stdoutSize': self.spooledSize(self.stdoutPath),
+            'stderrSize': self.spooledSize(self.stderrPath),
+            **self.info,
+            }
+
+    def createSpoolFiles(self):
+        # Create empty output spool files up front so a Job's output can be
+        # fetched, and is empty, before the Job runs or if it never does.
+        for path in [self.stdoutPath, self.stderrPath]:
+            open(path, 'wb').close()
+
+    def removeSpoolFiles(self):
+        for path in [self.stdinPath, self.stdoutPath, self.stderrPath]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class JobScheduler:
+    def __init__(self, maxRunning=None, maxPending=None, timeout=None,
+                 ttl=None, spoolDirectory=None, maxInputSize=None):
+        self.jobs = {}  # Job id -> Job.
+        self.maxInputSize = maxInputSize or DEFAULT_MAX_INPUT_SIZE
+        self.timeout = timeout or DEFAULT_JOB_TIMEOUT
+        self.ttl = ttl if ttl is not None else DEFAULT_JOB_TTL
+        self.maxPending = maxPending or DEFAULT_MAX_PENDING
+        self.slots = curio.Semaphore(maxRunning or DEFAULT_MAX_RUNNING)
+
+        self._ownsSpoolDirectory = spoolDirectory is None
+        self.spoolDirectory = (
+            spoolDirectory or tempfile.mkdtemp(prefix='utilbind-jobs-'))
+
+    async def submit(self, argv, stdin=None, **info):
+        # <stdin>, if provided, is an async iterable of bytes chunks, like a
+        # request body, that's spooled to disk, as-is, as the Job's input.
+        # Raises TooManyJobs, or JobInputTooLarge if <stdin> exceeds
+        # self.maxInputSize.
+        self.removeExpiredJobs()
+
+        pending = [
+            j for j in self.jobs.values() if j.state is JobState.PENDING]
+        if len(pending) >= self.maxPending:
+            raise TooManyJobs(f'Too many pending jobs ({len(pending)}).')
+
+        job = Job(argv, self.spoolDirectory, **info)
+        try:
+            if stdin is not None:
+                await self._spoolInput(job, stdin)
+            job.createSpoolFiles()
+        except BaseException:  # E.g. the client went away mid-upload.
+            job.removeSpoolFiles()
+            raise
+
+        self.jobs[job.id] = job
+        job.task = await curio.spawn(self._runJob, job, daemon=True)
+
+        return job
+
+    def get(self, jobId):
+        self.removeExpiredJobs()
+        return self.jobs.get(jobId)
+
+    async def remove(self, jobId):
+        job = self.jobs.pop(jobId, None)
+        if job:
+            if not job.isDone:
+                await job.task.cancel()
+            job.removeSpoolFiles()
+        return job
+
+    async def removeExpiredJobsForever(self, interval=None):
+        while True:
+            await curio.sleep(interval or DEFAULT_SWEEP_INTERVAL)
+            self.removeExpiredJobs()
+
+    def removeExpiredJobs(self):
+        now = time.time()
+        expired = [j for j in self.jobs.values() if j.isExpired(self.ttl, now)]
+        for job in expired:
+            del self.jobs[job.id]
+            job.removeSpoolFiles()
+
+    def close(self):
+        for job in self.jobs.values():
+            job.removeSpoolFiles()
+        self.jobs.clear()
+        if self._ownsSpoolDirectory:
+            shutil.rmtree(self.spoolDirectory, ignore_errors=True)
+
+    async def _spoolInput(self, job, stdin):
+        size = 0
+        async with curio.aopen(job.stdinPath, 'wb') as f, \
+                   finalize(stdin) as stdin:
+            async for chunk in stdin:
+                size += len(chunk)
+                if size > self.maxInputSize:
+                    raise JobInputTooLarge(
+                        f'Job input exceeds {self.maxInputSize} bytes.')
+                await f.write(chunk)
+
+    async def _runJob(self, job):
+        try:
+            async with self.slots:
+                job.state = JobState.RUNNING
+                job.started = time.time()
+                await self._spawnAndWait(job)
+        except CancelledError:
+            job.state = JobState.CANCELLED
+            raise
+        except Exception:  # E.g. the executable or spool files are missing.
+            job.state = JobState.FAILED
+            print(f'Job {job.id} failed to run:')
+            print(traceback.format_exc())
+        finally:
+            job.finished = time.time()
+
+    async def _spawnAndWait(self, job):
+        stdin = open(job.stdinPath, 'rb') if isfile(job.stdinPath) else DEVNULL
+        try:
+            with open(job.stdoutPath, 'wb') as stdout, \
+                 open(job.stderrPath, 'wb') as stderr:
+                proc = Popen(
+                    job.argv, stdin=stdin, stdout=stdout, stderr=stderr)
+                try:
+                    async with timeout_after(self.timeout):
+                        job.returncode = await proc.wait()
+                except (TaskTimeout, CancelledError) as e:
+                    proc.kill()
+                    job.returncode = await proc.wait()
+                    if isinstance(e, CancelledError):
+                        raise
+                    job.state = JobState.TIMED_OUT
+                else:
+                    job.state = (
+                        JobState.SUCCEEDED if job.returncode == 0 else
+                        JobState.FAILED)
+        finally:
+            if stdin is not DEVNULL:
+                stdin.close()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Copyright _!_
+#
+# License _!_
+#
+# Original author: Ansgar Grunseid
+
+# A sampling profiler that profiles individual curio tasks, or parts thereof,
+# rather than the whole process. All curio tasks run interleaved in the
+# kernel's thread, so a process-wide profiler, like cProfile, would attribute
+# every other task's work to the task being profiled. Instead, profiled
+# coroutines are wrapped in profile(), which marks the profiler active only
+# while the wrapped coroutine itself is executing, i.e. between the kernel
+# resuming it and it yielding back to the kernel. An interval timer,
+# setitimer(ITIMER_REAL), runs only while the profiler is active, paused and
+# resumed around every step, and so fires once every <interval> seconds of
+# profiled execution. Its SIGALRM handler records the interrupted stack.
+#
+# Sampling in the kernel's thread itself, rather than from a separate sampling
+# thread, matters: a sampling thread needs the GIL to take a sample, which the
+# kernel's thread only releases during syscalls, so such samples would land
+# almost exclusively on I/O and miss pure Python work, like parsing, entirely.
+# ITIMER_PROF and ITIMER_VIRTUAL are unsuitable too, as they're only checked
+# on scheduler ticks, which short bursts of work, like serving a request
+# between two waits for I/O, usually miss.
+#
+# Signal handlers only run in the main thread, so profile() must be called from
+# a curio kernel running in the main thread. SIGALRM and ITIMER_REAL are taken
+# over while profiling.
+#
+# Samples are accumulated as collapsed stacks, one 'outer;...;inner <count>'
+# line per unique stack, which can be fed directly into flamegraph.pl
+# (https://github.com/brendangregg/FlameGraph) or speedscope.
+
+import types
+import signal
+from collections import Counter
+from os.path import basename
+
+DEFAULT_SAMPLE_INTERVAL = 0.001  # Seconds.
+
+def frameName(frame):
+    code = frame.f_code
+    location = f'{basename(code.co_filename)}:{code.co_firstlineno}'
+    return f'{code.co_name} ({location})'
+
+def collapseStack(frame):
+    names = []
+    while frame is not None:
+        names.append(frameName(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    def __init__(self, interval=None):
+        self.interval = interval or DEFAULT_SAMPLE_INTERVAL
+        self.stacks = Counter()  # Collapsed stack -> number of samples.
+
+        self._active = 0  # Number of profiled coroutines currently executing.
+        self._remaining = self.interval  # Until the next sample, when resumed.
+        self._handlerInstalled = False
+
+    def profile(self, coro):
+        """
+        Return an awaitable that runs coroutine <coro> and samples it, and
+        only it, while it executes. Usage:
+
+          result = await sampler.profile(someCoroutine(*args))
+        """
+        self._ensureSignalHandler()
+        return self._stepProfiled(coro)
+
+    def collapsed(self):
+        # Snapshot self.stacks before iterating, as the sampling signal
+        # handler may add stacks between any two bytecodes, including while a
+        # profiled request, like GET /_profile, renders them.
+        stacks = list(self.stacks.items())
+        lines = [f'{stack} {count}' for stack, count in stacks]
+        return '\n'.join(sorted(lines)) + ('\n' if lines else '')
+
+    def clear(self):
+        self.stacks.clear()
+
+    @types.coroutine
+    def _stepProfiled(self, coro):
+        # Drive <coro> by hand, forwarding every trap it yields to the kernel
+        # and every value, or exception, the kernel sends back to <coro>, and
+        # activate sampling around each step.
+        value, exc = None, None
+        while True:
+            self._activate()
+            try:
+                if exc is not None:
+                    trap = coro.throw(exc)
+                else:
+                    trap = coro.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self._deactivate()
+
+            try:
+                value, exc = (yield trap), None
+            except BaseException as e:
+                value, exc = None, e
+
+    def _activate(self):
+        self._active += 1
+        if self._active == 1:  # Resume the timer where it left off.
+            signal.setitimer(
+                signal.ITIMER_REAL, self._remaining, self.interval)
+
+    def _deactivate(self):
+        self._active -= 1
+        if not self._active:  # Pause the timer.
+            remaining, _ = signal.setitimer(signal.ITIMER_REAL, 0)
+            self._remaining = remaining or self.interval
+
+    def _ensureSignalHandler(self):
+        if not self._handlerInstalled:
+            signal.signal(signal.SIGALRM, self._sample)
+            self._handlerInstalled = True
+
+    def _sample(self, signum, frame):
+        if self._active and frame is not None:
+            self.stacks[collapseStack(frame)] += 1